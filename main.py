@@ -1,73 +1,241 @@
 import os
-import pickle
+import json
 import mimetypes
 import hashlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from pathlib import Path
 from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
 from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
 
 # Configuration
 LOCAL_FOLDER = "/home/angus/synced-gdrive"  # Change this to your desired folder
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 CREDENTIALS_FILE = 'credentials.json'
-TOKEN_FILE = 'token.pickle'
+TOKEN_FILE = 'token.json'
+CHECKSUM_CACHE_FILE = '.md5cache.json'
+CACHE_SAVE_INTERVAL = 30  # Seconds between checksum cache checkpoints during a sync
 DRIVE_FOLDER_NAME = 'backup-gs65'
+MAX_UPLOADS = 4  # Concurrent upload threads
+MAX_WRITES_PER_SECOND = 8  # Stay below Drive's per-user write quota
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024  # Larger files use resumable uploads
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+PAGE_CACHE_MAX_SIZE = 64 * 1024 * 1024  # Larger files are evicted once uploaded
+MAX_TRIES = 6  # Attempts per Drive request before giving up
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+TEMP_FILE_SUFFIXES = ('.swp', '.swo', '.swx', '~')  # Editor swap/backup files
+TEMP_FILE_NAMES = {'4913'}  # Vim's write-permission probe file
+
+class RateLimiter:
+    """Space out calls so no more than `rate` happen per second across threads"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+# Extension -> MIME type, resolved once instead of via guess_type per file
+mimetypes.init()
+EXT_MIME = dict(mimetypes.types_map)
+
+write_limiter = RateLimiter(MAX_WRITES_PER_SECOND)
+thread_local = threading.local()
+
+def get_drive_service(creds):
+    """Return this thread's Drive service (googleapiclient http objects aren't thread-safe)"""
+    if not hasattr(thread_local, 'drive_service'):
+        thread_local.drive_service = build('drive', 'v3', credentials=creds)
+    return thread_local.drive_service
+
+def call_with_retry(call, max_tries=MAX_TRIES):
+    """Run a Drive call, backing off exponentially on rate limits and server errors"""
+    for attempt in range(max_tries):
+        try:
+            return call()
+        except HttpError as e:
+            if e.resp.status not in RETRY_STATUSES or attempt == max_tries - 1:
+                raise
+            try:
+                delay = float(e.resp.get('retry-after', 2 ** attempt))
+            except ValueError:
+                delay = 2 ** attempt
+            delay += random.random()
+            print(f"Drive returned {e.resp.status}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def execute_with_retry(request):
+    """Execute a Drive request with retries"""
+    return call_with_retry(request.execute)
 
 def get_file_md5(file_path):
     """Calculate MD5 checksum of local file"""
     hash_md5 = hashlib.md5()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return hash_md5.hexdigest()
+        if hasattr(os, 'posix_fadvise'):
+            # Ask the kernel for larger readahead on this sequential scan
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        # Read into one reused buffer rather than allocating bytes per chunk
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while n := f.readinto(buffer):
+            hash_md5.update(view[:n])
     return hash_md5.hexdigest()
 
-def upload_file(drive_service, drive_folder_id, file_path):
+def drop_page_cache(file_path):
+    """Evict a file's pages once we're done reading it"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def get_file_md5_cached(file_path, cache):
+    """Return MD5 of local file, only rehashing when its mtime or size changed"""
+    st = os.stat(file_path)
+    cached = cache.get(file_path)
+    if cached and cached['mtime_ns'] == st.st_mtime_ns and cached['size'] == st.st_size:
+        return cached['md5']
+    
+    local_md5 = get_file_md5(file_path)
+    cache[file_path] = {
+        'mtime_ns': st.st_mtime_ns,
+        'size': st.st_size,
+        'md5': local_md5
+    }
+    return local_md5
+
+def load_checksum_cache():
+    """Load the on-disk checksum cache, or start a fresh one"""
+    if os.path.exists(CHECKSUM_CACHE_FILE):
+        try:
+            with open(CHECKSUM_CACHE_FILE) as f:
+                cache = json.load(f)
+        except Exception as e:
+            print(f"Ignoring unreadable checksum cache: {e}")
+            return {}
+        if not isinstance(cache, dict):
+            print("Ignoring malformed checksum cache")
+            return {}
+        # Drop entries that don't look like ours rather than failing on them later
+        return {path: entry for path, entry in cache.items()
+                if isinstance(entry, dict) and {'mtime_ns', 'size', 'md5'} <= entry.keys()}
+    return {}
+
+def save_checksum_cache(cache):
+    """Write the checksum cache atomically so an interrupted run can't corrupt it"""
+    # Snapshot first: worker threads may still be adding entries while we serialize
+    snapshot = {path: dict(entry) for path, entry in list(cache.items())}
+    tmp_file = CHECKSUM_CACHE_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_file, CHECKSUM_CACHE_FILE)
+
+def quote_query_value(value):
+    """Escape a string for use inside single quotes in a Drive query"""
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+def list_remote_index(drive_service, drive_folder_id):
+    """Map file name -> (id, md5) for everything in the Drive folder"""
+    remote_index = {}
+    page_token = None
+    while True:
+        response = execute_with_retry(drive_service.files().list(
+            q=f"'{drive_folder_id}' in parents and trashed=false",
+            fields="nextPageToken, files(id, name, md5Checksum)",
+            pageSize=1000,
+            pageToken=page_token
+        ))
+        for f in response.get('files', []):
+            remote_index[f['name']] = (f['id'], f.get('md5Checksum'))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return remote_index
+
+def get_modified_time(file_path):
+    """Local mtime as the RFC 3339 timestamp Drive expects"""
+    mtime = os.path.getmtime(file_path)
+    return datetime.fromtimestamp(mtime, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def make_media(file_path, mime_type):
+    """Small files go up in one multipart request, large ones resumably in chunks"""
+    if os.path.getsize(file_path) > RESUMABLE_THRESHOLD:
+        return MediaFileUpload(file_path, mimetype=mime_type,
+                               resumable=True, chunksize=UPLOAD_CHUNK_SIZE)
+    return MediaFileUpload(file_path, mimetype=mime_type)
+
+def execute_upload(request):
+    """Execute an upload request, sending resumable media chunk by chunk"""
+    if not request.resumable:
+        return execute_with_retry(request)
+    response = None
+    while response is None:
+        # A retried next_chunk() resumes from the last byte Drive acknowledged
+        _, response = call_with_retry(request.next_chunk)
+    return response
+
+def upload_file(drive_service, drive_folder_id, file_path, local_md5, remote_index):
     try:
         file_name = Path(file_path).name
-        local_md5 = get_file_md5(file_path)
         
         # Check if file already exists in Drive
-        existing_files = drive_service.files().list(
-            q=f"name='{file_name}' and parents in '{drive_folder_id}' and trashed=false",
-            fields="files(id, name, md5Checksum)"
-        ).execute()
+        entry = remote_index.get(file_name)
         
         # Detect MIME type
-        mime_type, _ = mimetypes.guess_type(file_path)
-        if mime_type is None:
-            mime_type = 'application/octet-stream'
+        extension = os.path.splitext(file_path)[1].lower()
+        mime_type = EXT_MIME.get(extension, 'application/octet-stream')
         
-        media = MediaFileUpload(file_path, mimetype=mime_type)
+        media = make_media(file_path, mime_type)
+        modified_time = get_modified_time(file_path)
         
-        if existing_files.get('files'):
-            # File exists - check if it has changed
-            file_id = existing_files['files'][0]['id']
-            drive_md5 = existing_files['files'][0].get('md5Checksum')
-            
-            if drive_md5 == local_md5:
-                print(f"Skipped {file_name} (unchanged)")
-                return
-            
-            # Update existing file
-            drive_service.files().update(
+        if entry:
+            # Update existing file (unchanged files are filtered out before upload)
+            file_id = entry[0]
+            write_limiter.acquire()
+            execute_upload(drive_service.files().update(
                 fileId=file_id,
+                body={'modifiedTime': modified_time},
                 media_body=media
-            ).execute()
+            ))
+            remote_index[file_name] = (file_id, local_md5)
             print(f"Updated {file_name} in Google Drive")
+            return file_id
         else:
             # Create new file
             file_metadata = {
                 'name': file_name,
-                'parents': [drive_folder_id]
+                'parents': [drive_folder_id],
+                'modifiedTime': modified_time
             }
-            drive_service.files().create(
+            write_limiter.acquire()
+            created = execute_upload(drive_service.files().create(
                 body=file_metadata,
                 media_body=media,
                 fields='id'
-            ).execute()
+            ))
+            remote_index[file_name] = (created['id'], local_md5)
             print(f"Uploaded {file_name} to Google Drive")
+            return created['id']
             
     except Exception as e:
         print(f"Error uploading {file_path}: {e}")
@@ -77,12 +245,13 @@ def authenticate_drive():
     
     # Load existing token
     if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'rb') as token:
-            creds = pickle.load(token)
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
     
     # If no valid credentials, get new ones
     if not creds or not creds.valid:
+        # OAuth machinery is only imported when the cached token can't be used
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             creds.refresh(Request())
         else:
             if not os.path.exists(CREDENTIALS_FILE):
@@ -90,22 +259,23 @@ def authenticate_drive():
                 print("Get it from: https://console.cloud.google.com/apis/credentials")
                 return None
                 
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(
                 CREDENTIALS_FILE, SCOPES)
             creds = flow.run_local_server(port=0)
         
         # Save credentials for next run
-        with open(TOKEN_FILE, 'wb') as token:
-            pickle.dump(creds, token)
+        with open(TOKEN_FILE, 'w') as token:
+            token.write(creds.to_json())
     
-    return build('drive', 'v3', credentials=creds)
+    return creds
 
 def create_drive_folder(service, folder_name):
     # Check if folder already exists
-    existing_folders = service.files().list(
-        q=f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and trashed=false",
+    existing_folders = execute_with_retry(service.files().list(
+        q=f"name='{quote_query_value(folder_name)}' and mimeType='application/vnd.google-apps.folder' and trashed=false",
         fields="files(id, name)"
-    ).execute()
+    ))
     
     if existing_folders.get('files'):
         folder_id = existing_folders['files'][0]['id']
@@ -116,18 +286,97 @@ def create_drive_folder(service, folder_name):
             'name': folder_name,
             'mimeType': 'application/vnd.google-apps.folder'
         }
-        folder = service.files().create(body=folder_metadata, fields='id').execute()
+        folder = execute_with_retry(service.files().create(body=folder_metadata, fields='id'))
         folder_id = folder.get('id')
         print(f"Created Drive folder: {folder_name}")
     
     return folder_id
 
-def sync_existing_files(service, folder_id, local_folder):
+def is_synced(file_path, st, remote_index, cache):
+    """Whether a file is unchanged since it was last confirmed on Drive, without hashing it"""
+    cached = cache.get(file_path)
+    if not cached or 'drive_file_id' not in cached:
+        return False
+    if cached['mtime_ns'] != st.st_mtime_ns or cached['size'] != st.st_size:
+        return False
+    return remote_index.get(Path(file_path).name) == (cached['drive_file_id'], cached['md5'])
+
+def is_temp_file(file_name):
+    """Whether a file is an editor artifact that shouldn't be backed up"""
+    return file_name.endswith(TEMP_FILE_SUFFIXES) or file_name in TEMP_FILE_NAMES
+
+def sync_existing_files(creds, folder_id, local_folder, cache):
     """Upload all existing files"""
-    all_files = Path(local_folder).glob('*')
-    for file_path in all_files:
-        if file_path.is_file():
-            upload_file(service, folder_id, str(file_path))
+    remote_index = list_remote_index(get_drive_service(creds), folder_id)
+    all_files = []
+    with os.scandir(local_folder) as entries:
+        for entry in entries:
+            if not entry.is_file() or is_temp_file(entry.name):
+                continue
+            try:
+                synced = is_synced(entry.path, entry.stat(), remote_index, cache)
+            except OSError as e:
+                print(f"Error reading {entry.path}: {e}")
+                continue
+            if synced:
+                print(f"Skipped {entry.name} (unchanged)")
+                continue
+            all_files.append(entry.path)
+    
+    last_save = time.monotonic()
+    
+    def checkpoint():
+        # Persist progress periodically so a killed run keeps the hashes it paid for
+        nonlocal last_save
+        if time.monotonic() - last_save >= CACHE_SAVE_INTERVAL:
+            try:
+                save_checksum_cache(cache)
+            except OSError as e:
+                print(f"Could not save checksum cache: {e}")
+            last_save = time.monotonic()
+    
+    def upload(file_path, local_md5):
+        file_id = upload_file(get_drive_service(creds), folder_id, file_path, local_md5, remote_index)
+        if file_id:
+            cache[file_path]['drive_file_id'] = file_id
+            # Don't let big files push everything else out of the page cache
+            if cache[file_path]['size'] > PAGE_CACHE_MAX_SIZE:
+                drop_page_cache(file_path)
+    
+    # Hash and upload in separate pools so network work starts as soon as
+    # the first checksum is ready instead of after each file's own hash
+    hashers = ThreadPoolExecutor(max_workers=os.cpu_count())
+    uploaders = ThreadPoolExecutor(max_workers=MAX_UPLOADS)
+    try:
+        hash_futures = {hashers.submit(get_file_md5_cached, file_path, cache): file_path
+                        for file_path in all_files}
+        upload_futures = []
+        for future in as_completed(hash_futures):
+            checkpoint()
+            file_path = hash_futures[future]
+            try:
+                local_md5 = future.result()
+            except Exception as e:
+                print(f"Error hashing {file_path}: {e}")
+                continue
+            # Touched but identical files stop here without taking an upload slot
+            entry = remote_index.get(os.path.basename(file_path))
+            if entry and entry[1] == local_md5:
+                cache[file_path]['drive_file_id'] = entry[0]
+                drop_page_cache(file_path)
+                print(f"Skipped {os.path.basename(file_path)} (unchanged)")
+                continue
+            upload_futures.append(uploaders.submit(upload, file_path, local_md5))
+        for future in as_completed(upload_futures):
+            checkpoint()
+            future.result()
+    except BaseException:
+        # Drop queued work so Ctrl-C stops the sync instead of draining both pools
+        hashers.shutdown(wait=False, cancel_futures=True)
+        uploaders.shutdown(wait=False, cancel_futures=True)
+        raise
+    hashers.shutdown()
+    uploaders.shutdown()
 
 def main():
     # Ensure local folder exists
@@ -135,18 +384,23 @@ def main():
     
     # Authenticate with Google Drive
     print("Authenticating with Google Drive...")
-    drive_service = authenticate_drive()
-    if not drive_service:
+    creds = authenticate_drive()
+    if not creds:
         return
     
     print("Authentication successful!")
+    drive_service = get_drive_service(creds)
     
     # Create/get Drive folder
     drive_folder_id = create_drive_folder(drive_service, DRIVE_FOLDER_NAME)
     
     # Sync existing files
     print("Backing up files...")
-    sync_existing_files(drive_service, drive_folder_id, LOCAL_FOLDER)
+    cache = load_checksum_cache()
+    try:
+        sync_existing_files(creds, drive_folder_id, LOCAL_FOLDER, cache)
+    finally:
+        save_checksum_cache(cache)
     print("Backup complete!")
 
 if __name__ == "__main__":